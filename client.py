@@ -3,16 +3,24 @@
 from dotenv import load_dotenv
 from requests.auth import HTTPBasicAuth
 import argparse
+import contextlib
 import datetime
 import errno
+import fcntl
 import requests
 import signal
 import sys, json, os
+import tempfile
 import time
 import yaml
 import re
 #import pdb
 
+try:
+    import websocket # websocket-client, only required for post-adjust stats sampling
+except ImportError:
+    websocket = None
+
 load_dotenv()
 
 # Remove proxy if set (as it might block or send unwanted requests to the proxy)
@@ -29,6 +37,10 @@ def number(x):
     else:
         return x
 
+class ConfigError(Exception):
+    """ Raised when the configuration cannot be read or is invalid """
+    pass
+
 # Client is a partial implementation of the Rancher API
 class RancherClient:
     """ """
@@ -484,17 +496,184 @@ class RancherClient:
             }
         return { 'application': { 'components': response} }
 
+    def instances(self, service_name):
+        """
+        :param service_name: The name of the service
+        :returns: dict of instance id to instance for the service's containers
+        :raises: requests.exceptions.RequestException or ValueError if the API call fails
+        """
+        response = self.render(self.services_uri(name=service_name) + '/instances', exit_on_error=False)
+        return { instance.get('id'): instance for instance in response.get('data', []) }
+
+    def parse_timestamp(self, value):
+        """
+        Parses an RFC 3339 timestamp as found in container stats samples. The fraction may have
+        nanosecond precision, which strptime cannot handle.
+        :param value: the timestamp string
+        :returns: the timestamp in seconds since the epoch, or None if it cannot be parsed
+        """
+        if not isinstance(value, str):
+            return None
+        match = re.match(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|([+-])(\d\d):?(\d\d))?$', value)
+        if not match:
+            return None
+        seconds = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+        seconds += float(match.group(2) or 0)
+        if match.group(4):
+            offset = int(match.group(5)) * 3600 + int(match.group(6)) * 60
+            seconds -= offset if match.group(4) == '+' else -offset
+        return seconds
+
+    def fold_stats(self, acc, stat, now):
+        """
+        Folds a single container stats sample into its running accumulator, so that memory use
+        stays constant no matter how many samples the stream delivers. Samples which are not newer
+        than the last one folded for the container are ignored.
+        :param acc: The accumulator for the container (updated in place)
+        :param stat: A container stats sample from the Rancher stats stream
+        :param now: The time at which the sample was received, used if it has no timestamp
+        """
+        timestamp = self.parse_timestamp(stat.get('timestamp'))
+        timestamp = now if timestamp is None else timestamp
+        if 'last' in acc and timestamp <= acc['last']['time']:
+            return
+
+        cpu_total = self.dig(stat, ['cpu', 'usage', 'total'])
+        periods = self.dig(stat, ['cpu', 'cfs', 'periods'])
+        throttled = self.dig(stat, ['cpu', 'cfs', 'throttled_periods'])
+        sample = {
+            'time': timestamp,
+            'cpu': cpu_total if cpu_total != {} else None,
+            'periods': periods if periods != {} else None,
+            'throttled': throttled if throttled != {} else None }
+        acc.setdefault('first', sample)
+        acc['last'] = sample
+        acc['samples'] = acc.get('samples', 0) + 1
+
+        mem = self.dig(stat, ['memory', 'usage'])
+        if mem != {}:
+            acc['mem_peak'] = max(acc.get('mem_peak', 0), mem)
+        mem_limit = stat.get('memLimit')
+        if mem_limit:
+            acc['mem_limit'] = mem_limit
+
+    def summarize_stats(self, service, accumulators, sigkill_exits):
+        """
+        Summarizes the sampled stats of all containers of a service against its launchConfig limits
+        :param service: The service as returned by the API after the upgrade
+        :param accumulators: dict of container id to accumulator filled by fold_stats
+        :param sigkill_exits: number of containers which exited with 137 during the sampling window
+        :returns: a dict summary; cpu values are in cores and mem values in GiB, as for adjust
+        """
+        launch_config = self.dig(service, ['launchConfig'])
+        cpu_quota = launch_config.get('cpuQuota')
+        cpu_limit = cpu_quota / (launch_config.get('cpuPeriod') or 1000*100) if cpu_quota else None
+        mem_limit = launch_config.get('memory')
+
+        cpu_usage = throttled_ratio = mem_peak = None
+        for acc in accumulators.values():
+            first, last = acc['first'], acc['last']
+            elapsed = last['time'] - first['time']
+            if elapsed > 0 and first['cpu'] is not None and last['cpu'] is not None:
+                usage = (last['cpu'] - first['cpu']) / (elapsed * 1e9) # cpu usage is in ns
+                cpu_usage = max(cpu_usage or 0, usage)
+            counters = (first['periods'], last['periods'], first['throttled'], last['throttled'])
+            if None not in counters and last['periods'] > first['periods']:
+                ratio = (last['throttled'] - first['throttled']) / (last['periods'] - first['periods'])
+                throttled_ratio = max(throttled_ratio or 0, ratio)
+            if 'mem_peak' in acc:
+                mem_peak = max(mem_peak or 0, acc['mem_peak'])
+            mem_limit = mem_limit or acc.get('mem_limit')
+
+        summary = {
+            'containers': len(accumulators),
+            'samples': sum(acc['samples'] for acc in accumulators.values()),
+            'cpu_limit': cpu_limit,
+            'cpu_usage': cpu_usage,
+            'cpu_usage_ratio': cpu_usage / cpu_limit if cpu_usage is not None and cpu_limit else None,
+            'cpu_throttled_ratio': throttled_ratio,
+            'mem_limit': mem_limit / (1024**3) if mem_limit else None, # convert from memory bytes to mem in GiB
+            'mem_usage_peak': mem_peak / (1024**3) if mem_peak is not None else None,
+            'mem_usage_ratio': mem_peak / mem_limit if mem_peak is not None and mem_limit else None,
+            'sigkill_exits': sigkill_exits }
+        return { key: value for key, value in summary.items() if value is not None }
+
+    def sample_stats(self, service_name, deadline, stop=None):
+        """
+        Samples per-container stats for a service from the Rancher stats stream until a deadline
+        after an upgrade, so that limits which are too tight show up right away.
+        https://rancher.com/docs/rancher/v1.6/en/api/v2-beta/api-resources/service/
+        API failures are raised rather than exiting, as sampling must not fail an applied adjust.
+        :param service_name: The name of the service to sample
+        :param deadline: When to stop sampling, in seconds since the epoch
+        :param stop: An optional threading.Event which ends sampling early when set (Default value = None)
+        :returns: a summary of cpu throttling, memory use relative to the limit and SIGKILL exits
+        """
+        if websocket is None:
+            return { 'error': 'websocket-client is not installed, cannot sample container stats' }
+
+        service = self.render(self.services_uri(name=service_name), exit_on_error=False)
+        before = self.instances(service_name)
+        token = self.render(self.services_uri(name=service_name) + '/containerstats', exit_on_error=False)
+        url = '{}?token={}'.format(token.get('url'), token.get('token'))
+
+        accumulators = {}
+        ws = websocket.create_connection(url, timeout=max(deadline - time.time(), 1))
+        try:
+            while stop is None or not stop.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                ws.settimeout(min(remaining, 1)) # wake up regularly to check for a stop request
+                try:
+                    frame = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                except websocket.WebSocketConnectionClosedException:
+                    break # summarize what was sampled before the server closed the stream
+                now = time.time()
+                try:
+                    stats = json.loads(frame)
+                except ValueError:
+                    continue # skip partial or keepalive frames
+                for stat in stats if isinstance(stats, list) else [stats]:
+                    if not isinstance(stat, dict):
+                        continue
+                    self.fold_stats(accumulators.setdefault(stat.get('id'), {}), stat, now)
+        finally:
+            ws.close()
+
+        # Rancher does not report OOM kills in the stats stream. A container killed for exceeding
+        # its memory limit exits with 137, as does any other SIGKILL, so this is only a hint of OOM
+        # kills. Only count containers whose state changed during the window, so that containers
+        # stopped earlier or replaced by the upgrade are not included.
+        sigkill_exits = 0
+        for instance_id, instance in self.instances(service_name).items():
+            if instance.get('exitCode') != 137:
+                continue
+            previous = before.get(instance_id)
+            if previous is None:
+                changed = instance.get('state') == 'running'
+            else:
+                changed = any(instance.get(key) != previous.get(key) for key in ('state', 'startCount', 'exitCode'))
+            if changed:
+                sigkill_exits += 1
+
+        return self.summarize_stats(service, accumulators, sigkill_exits)
+
     def excluded(self, svc_name):
         return self.dig(self.config.services_config, [svc_name, 'exclude'])
 
-    def render(self, uri, action=None, body=None):
+    def render(self, uri, action=None, body=None, exit_on_error=True):
         """
         Render is the workhorse. It takes a URI and optional action or body
         If there is an action, a POST is made to the URI for that action
         If there is a body, a POST is made to the URI with that body
         If there is neither, a GET is made to the URI
         In all cases, we return a dict of the JSON response (even on errors)
-        Upon exception, it will print an error message and exit.
+        Upon exception, it will print an error message and exit, unless exit_on_error is False in
+        which case the exception is raised to the caller.
         Possible Actions:
         * activateservices
         * cancelrollback
@@ -507,6 +686,7 @@ class RancherClient:
         :param uri: to operate on
         :param action: suggests a POST operation  (Default value = None)
         :param body: suggests a PUT operation (Default value = None)
+        :param exit_on_error: exit on failure rather than raising (Default value = True)
         :returns: the API response as a dict
         """
         url = self.config.api_url + uri
@@ -532,6 +712,8 @@ class RancherClient:
         except requests.exceptions.HTTPError as http_error:
             print("Rachner API call failed, status code {}, response:\n---\n{}\n---\n".format(
                 response.status_code, response.text), file=sys.stderr)
+            if not exit_on_error:
+                raise
             try:
                 message = json.loads(response.text)['message']
             except Exception:
@@ -546,6 +728,8 @@ class RancherClient:
         except Exception as e:
             message = "Failed to parse Rancher API response as JSON: {}\nContents:\n---\n{}\n---\n".format(str(e), response.text)
             print(message, file=sys.stderr)
+            if not exit_on_error:
+                raise
             error = { 'error': 500, 'class': 'failure', 'message': message }
             self.print(error)
             sys.exit(3)
@@ -561,6 +745,251 @@ class RancherClient:
         """
         print(json.dumps(data, sort_keys=True), file=file)
 
+class RancherStackLock:
+    """
+    Per-stack advisory lock which serializes adjust runs against the same stack.
+    The lock is an flock(2) on a file in the configured lock directory, so it is released by the
+    kernel whenever the holding process exits, including after a cancelled upgrade.
+    When coalescing, each run queues its desired settings in a per-stack pending file before
+    waiting on the lock. Whoever holds the lock next claims all queued entries and applies them
+    merged per service, newest winning. Each run also holds an flock on an owner file for its entry,
+    so entries of runs which died or gave up are ignored rather than applied.
+    """
+    def __init__(self, client, stack_name):
+        self.client = client
+        self.base = os.path.join(client.config.lock_dir,
+            'servo-rancher-' + re.sub(r'[^A-Za-z0-9_.-]', '_', str(stack_name)))
+        self.stack_name = stack_name
+        self.lock_path = self.base + '.lock'
+        self.pending_path = self.base + '.pending.json'
+        self.pending_lock_path = self.base + '.pending.lock'
+        self.file = None
+        self.token = None
+        self.owner = None
+
+    def acquire(self, timeout=None, components=None):
+        """
+        Blocks until the stack lock is held. Reports a waiting progress message if another adjust
+        already holds it. If the wait times out or is cancelled, the run's queued entry is withdrawn
+        so that settings reported as failed or cancelled are never applied by another run. If the
+        lock holder has already claimed the entry, the run keeps waiting for that result instead.
+        :param timeout: Seconds to wait before giving up, or None to wait indefinitely (Default value = None)
+        :param components: Adjust components to queue when coalescing (Default value = None)
+        :raises: TimeoutError if the lock could not be acquired in time
+        :returns: the token of the queued entry, or None if nothing was queued
+        """
+        def cancel(signum, frame):
+            if not self.withdraw():
+                self.client.print({
+                    'message': 'settings are being applied by a concurrent adjust, waiting for it',
+                    'stage': 'waiting' })
+                return
+            self.client.print({
+                'message': 'cancelled while waiting for another adjust on stack {}'.format(self.stack_name),
+                'state': 'Cancelled' })
+            sys.exit(1)
+
+        # handlers go in first, so a cancel can never leave a queued entry behind
+        previous = { signum: signal.signal(signum, cancel) for signum in (signal.SIGUSR1, signal.SIGINT) }
+        try:
+            if components is not None:
+                self.queue(components)
+            self.file = open(self.lock_path, 'a')
+            start = time.time()
+            waiting = False
+            while True:
+                try:
+                    fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return self.token
+                except BlockingIOError:
+                    pass
+                if timeout is not None and time.time() - start >= timeout:
+                    if self.withdraw():
+                        self.file.close()
+                        self.file = None
+                        raise TimeoutError('timed out after {}s waiting for another adjust on stack {}'.format(
+                            timeout, self.stack_name))
+                    self.client.print({
+                        'message': 'settings are being applied by a concurrent adjust, waiting for it',
+                        'stage': 'waiting' })
+                    timeout = None
+                if not waiting:
+                    self.client.print({
+                        'progress': 0,
+                        'message': 'waiting for another adjust on stack {}'.format(self.stack_name),
+                        'stage': 'waiting'})
+                    waiting = True
+                time.sleep(1)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def release(self):
+        """ Releases the stack lock and this run's owner file if held. """
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        if self.owner is not None:
+            self.owner.close()
+            self.owner = None
+            try:
+                os.remove(self.owner_path(self.token))
+            except OSError:
+                pass
+
+    def owner_path(self, token):
+        return '{}.owner-{}'.format(self.base, token)
+
+    def alive(self, token):
+        """
+        :param token: The token of a queued entry
+        :returns: True if the run which queued the entry still holds its owner file
+        """
+        try:
+            fd = os.open(self.owner_path(token), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        # nobody holds it any more, clean up after the run which left it behind
+        try:
+            os.remove(self.owner_path(token))
+        except OSError:
+            pass
+        return False
+
+    @contextlib.contextmanager
+    def pending_guard(self):
+        """
+        Short-lived lock guarding reads and writes of the pending file. Cancel signals are held
+        back meanwhile, as their handler takes this lock too.
+        """
+        signals = {signal.SIGUSR1, signal.SIGINT}
+        blocked = signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        try:
+            with open(self.pending_lock_path, 'a') as guard:
+                fcntl.flock(guard, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(guard, fcntl.LOCK_UN)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+    def read_pending(self):
+        """
+        Must be called within pending_guard()
+        :returns: a dict with the list of queued 'entries', oldest first, and the 'results' of
+            entries which were applied by another run, by token
+        """
+        try:
+            with open(self.pending_path, 'r') as stream:
+                pending = json.load(stream)
+        except (IOError, ValueError):
+            pending = None
+        if not isinstance(pending, dict):
+            pending = {}
+        pending.setdefault('entries', [])
+        pending.setdefault('results', {})
+        return pending
+
+    def write_pending(self, pending):
+        """
+        Must be called within pending_guard()
+        :param pending: a dict as returned by read_pending()
+        """
+        if pending['entries'] or pending['results']:
+            with open(self.pending_path, 'w') as stream:
+                json.dump(pending, stream)
+        elif os.path.exists(self.pending_path):
+            os.remove(self.pending_path)
+
+    def queue(self, components):
+        """
+        Queues desired settings as the latest state for the stack
+        :param components: The adjust components to apply
+        :returns: a token identifying this entry
+        """
+        token = '{}-{}'.format(os.getpid(), time.time())
+        self.token = token
+        self.owner = open(self.owner_path(token), 'a')
+        fcntl.flock(self.owner, fcntl.LOCK_EX)
+        with self.pending_guard():
+            pending = self.read_pending()
+            pending['entries'].append({'token': token, 'components': components})
+            self.write_pending(pending)
+        return token
+
+    def pending(self):
+        """
+        Claims all queued entries of live runs for the lock holder. Claims left by an earlier
+        holder are taken over, as that holder has released the lock.
+        :returns: a dict with the 'token' of the latest entry and the 'components' of all entries
+            merged per service, newest winning; or None if there is nothing left to apply
+        """
+        with self.pending_guard():
+            pending = self.read_pending()
+            pending['entries'] = [entry for entry in pending['entries'] if self.alive(entry.get('token'))]
+            pending['results'] = { token: result for token, result in pending['results'].items() if self.alive(token) }
+            components = {}
+            for entry in pending['entries']:
+                entry['in_progress'] = True
+                components.update(entry.get('components', {}))
+            self.write_pending(pending)
+        if not pending['entries']:
+            return None
+        return {'token': pending['entries'][-1].get('token'), 'components': components}
+
+    def applied(self, skipped={}):
+        """
+        Clears the entries claimed by pending() once applied. Entries queued in the meantime are kept.
+        Services which could not be upgraded are recorded for the runs which queued them, so they
+        can report the failures themselves without a second rollout.
+        :param skipped: dict of service name to error message for services which were not upgraded
+        """
+        with self.pending_guard():
+            pending = self.read_pending()
+            for entry in pending['entries']:
+                if not entry.get('in_progress') or entry.get('token') == self.token:
+                    continue
+                failures = { name: message for name, message in skipped.items() if name in entry.get('components', {}) }
+                if failures:
+                    pending['results'][entry.get('token')] = failures
+            pending['entries'] = [entry for entry in pending['entries'] if not entry.get('in_progress')]
+            self.write_pending(pending)
+
+    def result(self):
+        """
+        :returns: dict of service name to error message for services of this run's entry which
+            another run could not upgrade
+        """
+        with self.pending_guard():
+            pending = self.read_pending()
+            failures = pending['results'].pop(self.token, {})
+            self.write_pending(pending)
+        return failures
+
+    def withdraw(self):
+        """
+        Removes this run's queued entry, leaving any other entries queued.
+        :returns: False if the entry has been claimed by the lock holder and cannot be withdrawn
+        """
+        if self.token is None:
+            return True
+        with self.pending_guard():
+            pending = self.read_pending()
+            for entry in pending['entries']:
+                if entry.get('token') == self.token and entry.get('in_progress'):
+                    return False
+            pending['entries'] = [entry for entry in pending['entries'] if entry.get('token') != self.token]
+            self.write_pending(pending)
+        return True
+
 class RancherConfig:
     """
     Handles configuration for the Client.
@@ -581,6 +1010,11 @@ class RancherConfig:
         self.project = conf.get('project', os.getenv('OPTUNE_PROJECT'))
         self.stack = conf.get('stack', os.getenv('OPTUNE_STACK'))
         self.services_config = conf.get('services', {})
+        self.lock_dir = conf.get('lock_dir', os.getenv('OPTUNE_LOCK_DIR', tempfile.gettempdir()))
+        self.lock_timeout = conf.get('lock_timeout', os.getenv('OPTUNE_LOCK_TIMEOUT')) # parsed by adjust_options()
+        coalesce = conf.get('coalesce', os.getenv('OPTUNE_COALESCE', 'false'))
+        self.coalesce = coalesce if isinstance(coalesce, bool) else str(coalesce).lower() in ('1', 'true', 'yes')
+        self.stats_window = conf.get('stats_window', os.getenv('OPTUNE_STATS_WINDOW')) # parsed by adjust_options()
         self.rancher_to_servo = { 'cpuQuota': 'cpu', 'memory': 'mem', 'scale': 'replicas' }
         self.services_defaults = { 'cpuQuota': { 'min': 0.1, 'max': 3.5, 'type': 'range' },
                                    'memory': { 'min': 0.25, 'max': 4, 'type': 'range'},
@@ -593,6 +1027,29 @@ class RancherConfig:
         self.api_url += 'v2-beta'
 
 
+    def seconds(self, name, value):
+        """
+        :param name: The name of the option, for error messages
+        :param value: The configured value
+        :raises: ConfigError if the value is not a number
+        :returns: the value as a float, or None if unset or empty
+        """
+        if value is None or value == '':
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ConfigError("{} must be a number of seconds, got {!r}".format(name, value))
+
+    def adjust_options(self):
+        """
+        Parses the options only used by adjust, so that a malformed value does not prevent
+        --describe or --info from running.
+        :raises: ConfigError if an option is malformed
+        """
+        self.lock_timeout = self.seconds('lock_timeout', self.lock_timeout) # None waits indefinitely
+        self.stats_window = self.seconds('stats_window', self.stats_window) or 0 # 0 disables sampling
+
     def read_config(self, filename):
         """
         Reads a YAML configuration file.